@@ -6,30 +6,58 @@ Receives MAVLink JSON telemetry, publishes to MQTT, and broadcasts over WebSocke
 
 import json
 import logging
+import math
 import signal
 import sys
 import time
 import socket
+import select
 import asyncio
 import threading
+import ctypes
+import errno
+import collections
 from datetime import datetime
 from typing import Optional
 import paho.mqtt.client as mqtt
 import websockets
 
+# msgspec is the supported JSON codec; stdlib json is only a fallback
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Configuration
 MAVLINK_HOST = "127.0.0.1"
 MAVLINK_PORT = 14550
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_TOPIC_TELEMETRY = "mavlink/telemetry"
+MQTT_TOPIC_TELEMETRY_MSGPACK = "mavlink/telemetry/msgpack"
 MQTT_TOPIC_ALERT = "mavlink/alert"
+MQTT_MAX_INFLIGHT = 200
+MQTT_SNDBUF = 1 << 20
 BATTERY_CRITICAL_VOLTAGE = 21.0  # 6S pack critical threshold
 WEBSOCKET_PORT = 8765
+WS_QUEUE_SIZE = 256  # Oldest telemetry is dropped if WebSocket clients fall behind
+WS_MAX_WRITE_BUFFER = 8 * 1024  # Bytes buffered before a slow client is skipped (well below websockets' write limit)
+WS_SEND_TIMEOUT = 0.5  # Seconds a client send may block before the client is dropped
+TELEMETRY_QOS1_INTERVAL = 10  # Every Nth telemetry publish is sent at QoS 1
+RECV_BUFFER_SIZE = 4096
+RECV_BATCH_SIZE = 32  # Datagrams pulled per recvmmsg() call
+MAVLINK_RCVBUF = 4 << 20
 
 # Setup logging
 import os
 LOG_FILE = os.environ.get('MAVLINK_LOG_FILE', 'mavlink_daemon.log')
+TELEMETRY_FORMAT = os.environ.get('MAVLINK_TELEMETRY_FORMAT', 'json')  # "json" or "msgpack"
+# SO_REUSEPORT sockets sharing the MAVLink port; the kernel hashes each sender to one worker
+RECEIVER_WORKERS = int(os.environ.get('MAVLINK_RECEIVER_WORKERS', '1'))
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -40,11 +68,128 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ---------------- JSON helpers ----------------
+def _finite(values: tuple) -> tuple:
+    # NaN/inf would be emitted as invalid JSON in the alert payload
+    if not all(map(math.isfinite, values)):
+        raise ValueError(f"non-finite telemetry value in {values}")
+    return values
+
+if msgspec is not None:
+    # Decode straight into typed fields in one pass
+    class TelemetryPacket(msgspec.Struct):
+        altitude: float = 0.0
+        airspeed: float = 0.0
+        battery_voltage: float = 0.0
+
+    _telemetry_decoder = msgspec.json.Decoder(TelemetryPacket, strict=False)
+    TELEMETRY_DECODE_ERRORS = (ValueError, TypeError, msgspec.DecodeError)
+    json_dumps = msgspec.json.Encoder().encode
+
+    def decode_telemetry(data: bytes) -> tuple:
+        packet = _telemetry_decoder.decode(data)
+        return _finite((packet.altitude, packet.airspeed, packet.battery_voltage))
+else:
+    TELEMETRY_DECODE_ERRORS = (ValueError, TypeError, AttributeError)
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def decode_telemetry(data: bytes) -> tuple:
+        packet = json.loads(bytes(data))
+        return _finite((
+            float(packet.get("altitude", 0.0)),
+            float(packet.get("airspeed", 0.0)),
+            float(packet.get("battery_voltage", 0.0)),
+        ))
+
+# ---------------- Batched UDP receive ----------------
+# recvmmsg() is used rather than io_uring: the available Python liburing
+# bindings cannot safely register provided-buffer rings, and at telemetry
+# rates batching already removes most of the per-datagram syscall cost.
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+def _load_recvmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        recvmmsg = ctypes.CDLL("libc.so.6", use_errno=True).recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+class MMsgReceiver:
+    """Pulls up to RECV_BATCH_SIZE datagrams per syscall into preallocated buffers."""
+
+    def __init__(self, sock: socket.socket, batch_size: int = RECV_BATCH_SIZE,
+                 buffer_size: int = RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.iovecs = (_IOVec * batch_size)()
+        self.msgs = (_MMsgHdr * batch_size)()
+        for i, buf in enumerate(self.buffers):
+            c_buf = (ctypes.c_char * buffer_size).from_buffer(buf)
+            self.iovecs[i].iov_base = ctypes.addressof(c_buf)
+            self.iovecs[i].iov_len = buffer_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self) -> list:
+        """Wait for the socket timeout, then return views of every queued datagram.
+
+        Views point into reused buffers and are only valid until the next call.
+        """
+        ready, _, _ = select.select([self.sock], [], [], self.sock.gettimeout())
+        if not ready:
+            raise socket.timeout("timed out")
+        count = _recvmmsg(self.sock.fileno(), self.msgs, self.batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        return [self.views[i][:self.msgs[i].msg_len] for i in range(count)]
+
+class RecvFromReceiver:
+    """Single-datagram fallback for platforms without recvmmsg, using a reused buffer."""
+
+    def __init__(self, sock: socket.socket, buffer_size: int = RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def receive(self) -> list:
+        nbytes, addr = self.sock.recvfrom_into(self.buffer)
+        return [self.view[:nbytes]]
+
 class MAVLinkDaemon:
     def __init__(self):
         self.running = False
         self.mqtt_client: Optional[mqtt.Client] = None
-        self.mavlink_socket: Optional[socket.socket] = None
+        self._mqtt_up = False  # Tracked via callbacks to avoid paho's locked is_connected()
+        self.mavlink_sockets: list = []
+        self.receivers: list = []
         self.last_telemetry = {
             "altitude": 0.0,
             "airspeed": 0.0,
@@ -52,8 +197,24 @@ class MAVLinkDaemon:
             "timestamp": None
         }
         self.alert_sent = False
+        self._pub_counter = 0
+        self._iso_cache = (None, "")  # (second, formatted), swapped atomically across workers
+        self.use_msgpack = TELEMETRY_FORMAT == "msgpack"
+        if self.use_msgpack and msgpack is None:
+            logger.warning("msgpack not installed, publishing telemetry as JSON")
+            self.use_msgpack = False
+        # Static part of the alert JSON; only voltage and timestamp change per alert
+        self._alert_prefix = json_dumps({
+            "type": "CRITICAL_ALERT",
+            "priority": "HIGH",
+            "threshold": BATTERY_CRITICAL_VOLTAGE,
+            "action_required": "IMMEDIATE_LANDING_RECOMMENDED"
+        })[:-1] + b',"message":"Battery voltage critical: '
         self.ws_clients = set()
         self.loop = asyncio.get_event_loop()
+        self._ws_queue = collections.deque(maxlen=WS_QUEUE_SIZE)
+        self._ws_event: Optional[asyncio.Event] = None
+        self._ws_task: Optional[asyncio.Task] = None
 
     # ---------------- MQTT Setup ----------------
     def setup_mqtt(self) -> bool:
@@ -65,6 +226,8 @@ class MAVLinkDaemon:
             )
             self.mqtt_client.on_connect = self._on_mqtt_connect
             self.mqtt_client.on_disconnect = self._on_mqtt_disconnect
+            self.mqtt_client.on_socket_open = self._on_mqtt_socket_open
+            self.mqtt_client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
             self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
             self.mqtt_client.loop_start()
             logger.info(f"MQTT client connected to {MQTT_BROKER}:{MQTT_PORT}")
@@ -75,21 +238,40 @@ class MAVLinkDaemon:
 
     def _on_mqtt_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
+            self._mqtt_up = True
             logger.info("MQTT connection established")
         else:
             logger.error(f"MQTT connection failed with code: {reason_code}")
 
     def _on_mqtt_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        self._mqtt_up = False
         logger.warning(f"MQTT disconnected with code: {reason_code}")
 
+    def _on_mqtt_socket_open(self, client, userdata, sock):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MQTT_SNDBUF)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            logger.warning(f"Failed to tune MQTT socket: {e}")
+
     # ---------------- MAVLink UDP ----------------
     def setup_mavlink_receiver(self) -> bool:
+        workers = RECEIVER_WORKERS if hasattr(socket, "SO_REUSEPORT") else 1
         try:
-            self.mavlink_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.mavlink_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.mavlink_socket.bind((MAVLINK_HOST, MAVLINK_PORT))
-            self.mavlink_socket.settimeout(5.0)
-            logger.info(f"MAVLink receiver listening on {MAVLINK_HOST}:{MAVLINK_PORT}")
+            for _ in range(max(1, workers)):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.mavlink_sockets.append(sock)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MAVLINK_RCVBUF)
+                sock.bind((MAVLINK_HOST, MAVLINK_PORT))
+                sock.settimeout(5.0)
+                if _recvmmsg is not None:
+                    self.receivers.append(MMsgReceiver(sock))
+                else:
+                    self.receivers.append(RecvFromReceiver(sock))
+            logger.info(f"MAVLink receiver listening on {MAVLINK_HOST}:{MAVLINK_PORT} ({len(self.receivers)} workers)")
             return True
         except Exception as e:
             logger.error(f"Failed to setup MAVLink receiver: {e}")
@@ -103,63 +285,115 @@ class MAVLinkDaemon:
         finally:
             self.ws_clients.remove(websocket)
 
-    async def broadcast_ws(self, telemetry: dict):
-        if self.ws_clients:
-            message = json.dumps(telemetry)
-            await asyncio.gather(*(client.send(message) for client in self.ws_clients))
+    async def send_ws(self, client, message: str):
+        # Bound the wait on a client's drain; a stalled client is dropped
+        try:
+            await asyncio.wait_for(client.send(message), WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping stalled WebSocket client %s", client.remote_address)
+            client.transport.abort()
+
+    async def broadcast_ws(self, message: str):
+        # Skip congested clients so a slow consumer cannot stall everyone else
+        ready = [client for client in self.ws_clients
+                 if client.transport.get_write_buffer_size() <= WS_MAX_WRITE_BUFFER]
+        if ready:
+            await asyncio.gather(*(self.send_ws(client, message) for client in ready), return_exceptions=True)
+
+    async def ws_broadcaster(self):
+        # Single consumer for telemetry queued by the receive thread
+        while True:
+            await self._ws_event.wait()
+            self._ws_event.clear()
+            while self._ws_queue:
+                await self.broadcast_ws(self._ws_queue.popleft())
+
+    def queue_ws(self, telemetry: dict):
+        if self._ws_event is None or not self.ws_clients:
+            return
+        self._ws_queue.append(json_dumps(telemetry).decode('utf-8'))
+        if not self._ws_event.is_set():
+            self.loop.call_soon_threadsafe(self._ws_event.set)
+
+    def _on_ws_task_done(self, task: asyncio.Task):
+        if task.cancelled():
+            logger.warning("WebSocket broadcaster cancelled")
+        elif task.exception() is not None:
+            logger.error("WebSocket broadcaster stopped: %r", task.exception())
 
     async def websocket_server(self):
+        self._ws_event = asyncio.Event()
+        self._ws_task = self.loop.create_task(self.ws_broadcaster())
+        self._ws_task.add_done_callback(self._on_ws_task_done)
         server = await websockets.serve(self.ws_handler, "0.0.0.0", WEBSOCKET_PORT)
         logger.info(f"WebSocket server running on ws://127.0.0.1:{WEBSOCKET_PORT}")
         await server.wait_closed()
 
     # ---------------- Telemetry ----------------
-    def process_telemetry(self, data: dict):
-        try:
-            altitude = float(data.get("altitude", 0.0))
-            airspeed = float(data.get("airspeed", 0.0))
-            battery_voltage = float(data.get("battery_voltage", 0.0))
-
-            self.last_telemetry = {
-                "altitude": altitude,
-                "airspeed": airspeed,
-                "battery_voltage": battery_voltage,
-                "timestamp": datetime.utcnow().isoformat()
-            }
-
-            # MQTT
-            self.publish_telemetry()
-            # Fail-safe
-            self.check_failsafe(battery_voltage)
-            # WebSocket
-            asyncio.run_coroutine_threadsafe(self.broadcast_ws(self.last_telemetry), self.loop)
-
-        except (KeyError, ValueError) as e:
-            logger.error(f"Error processing telemetry: {e}")
-
-    def check_failsafe(self, battery_voltage: float):
+    def process_telemetry(self, altitude: float, airspeed: float, battery_voltage: float,
+                          failsafe: bool = True):
+        epoch = time.time()
+        timestamp = self._iso_timestamp(epoch)
+
+        # Receiver workers run concurrently, so publish from locals and keep
+        # last_telemetry only as a snapshot of the most recent packet
+        telemetry = {
+            "altitude": altitude,
+            "airspeed": airspeed,
+            "battery_voltage": battery_voltage,
+            "timestamp": timestamp
+        }
+        self.last_telemetry = telemetry
+
+        # Fail-safe
+        alert_message = self.check_failsafe(battery_voltage, timestamp) if failsafe else None
+        # MQTT
+        self.publish_telemetry(telemetry, epoch, alert_message)
+        # WebSocket
+        self.queue_ws(telemetry)
+
+    def _iso_timestamp(self, now: float) -> str:
+        """UTC ISO8601 timestamp; the date/time part is formatted once per second."""
+        sec = int(now)
+        cached_sec, formatted = self._iso_cache
+        if sec != cached_sec:
+            formatted = datetime.utcfromtimestamp(sec).isoformat()
+            self._iso_cache = (sec, formatted)
+        return "%s.%06d" % (formatted, int((now - sec) * 1e6))
+
+    def check_failsafe(self, battery_voltage: float, timestamp: str) -> Optional[bytes]:
+        """Return the alert payload to publish, or None if the battery is fine."""
         if battery_voltage < BATTERY_CRITICAL_VOLTAGE:
-            logger.critical(f"CRITICAL ALERT: Battery voltage {battery_voltage}V below threshold {BATTERY_CRITICAL_VOLTAGE}V!")
-            alert_message = {
-                "type": "CRITICAL_ALERT",
-                "priority": "HIGH",
-                "message": f"Battery voltage critical: {battery_voltage}V",
-                "threshold": BATTERY_CRITICAL_VOLTAGE,
-                "current_voltage": battery_voltage,
-                "timestamp": datetime.utcnow().isoformat(),
-                "action_required": "IMMEDIATE_LANDING_RECOMMENDED"
-            }
-            if self.mqtt_client and self.mqtt_client.is_connected():
-                self.mqtt_client.publish(MQTT_TOPIC_ALERT, json.dumps(alert_message), qos=2, retain=True)
+            logger.critical("CRITICAL ALERT: Battery voltage %sV below threshold %sV!", battery_voltage, BATTERY_CRITICAL_VOLTAGE)
+            voltage = repr(battery_voltage).encode()
+            alert_message = b"".join((
+                self._alert_prefix, voltage,
+                b'V","current_voltage":', voltage,
+                b',"timestamp":"', timestamp.encode(), b'"}'
+            ))
             self.alert_sent = True
-        else:
-            if self.alert_sent and battery_voltage >= BATTERY_CRITICAL_VOLTAGE + 0.5:
-                self.alert_sent = False
-                logger.info("Battery voltage recovered above threshold")
+            return alert_message
+        if self.alert_sent and battery_voltage >= BATTERY_CRITICAL_VOLTAGE + 0.5:
+            self.alert_sent = False
+            logger.info("Battery voltage recovered above threshold")
+        return None
 
-    def publish_telemetry(self):
-        if self.mqtt_client and self.mqtt_client.is_connected():
-            self.mqtt_client.publish(MQTT_TOPIC_TELEMETRY, json.dumps(self.last_telemetry), qos=1)
+    def publish_telemetry(self, telemetry: dict, epoch: float, alert_message: Optional[bytes] = None):
+        # Any alert from check_failsafe is published right after its telemetry,
+        # under the same connection check
+        if self._mqtt_up:
+            # Stream at QoS 0; periodically send one at QoS 1 as a delivery heartbeat
+            self._pub_counter += 1
+            qos = 1 if self._pub_counter % TELEMETRY_QOS1_INTERVAL == 0 else 0
+            if self.use_msgpack:
+                payload = msgpack.packb({**telemetry, "timestamp": epoch}, use_bin_type=True)
+                self.mqtt_client.publish(MQTT_TOPIC_TELEMETRY_MSGPACK, payload, qos=qos)
+            else:
+                self.mqtt_client.publish(MQTT_TOPIC_TELEMETRY, json_dumps(telemetry), qos=qos)
+            if alert_message is not None:
+                info = self.mqtt_client.publish(MQTT_TOPIC_ALERT, alert_message, qos=2, retain=True)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logger.error("Failed to publish critical alert: %s", mqtt.error_string(info.rc))
 
     # ---------------- Main Loop ----------------
     def run(self):
@@ -176,29 +410,55 @@ class MAVLinkDaemon:
         # Start WebSocket server in background thread
         threading.Thread(target=lambda: self.loop.run_until_complete(self.websocket_server()), daemon=True).start()
 
+        # Extra receiver sockets get their own threads; the first runs here
+        workers = [
+            threading.Thread(target=self.receive_loop, args=(receiver,), daemon=True)
+            for receiver in self.receivers[1:]
+        ]
+        for worker in workers:
+            worker.start()
+
         logger.info("Daemon running, waiting for telemetry data...")
+        self.receive_loop(self.receivers[0])
+
+        for worker in workers:
+            worker.join()
+        self.shutdown()
 
+    def receive_loop(self, receiver):
         while self.running:
             try:
-                data, addr = self.mavlink_socket.recvfrom(4096)
-                telemetry = json.loads(data.decode('utf-8'))
-                self.process_telemetry(telemetry)
+                packets = []
+                for data in receiver.receive():
+                    try:
+                        packets.append(decode_telemetry(data))
+                    except TELEMETRY_DECODE_ERRORS as e:
+                        logger.error("Invalid telemetry received: %s", e)
+                if packets:
+                    # Per-packet fail-safe checks are only needed if some voltage in
+                    # the batch is critical or an earlier alert may now recover
+                    failsafe = self.alert_sent or min(packet[2] for packet in packets) < BATTERY_CRITICAL_VOLTAGE
+                    for packet in packets:
+                        # A failure on one packet must not drop the rest of the batch
+                        try:
+                            self.process_telemetry(*packet, failsafe=failsafe)
+                        except Exception as e:
+                            logger.error("Error processing telemetry: %s", e)
             except socket.timeout:
                 continue
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON received: {e}")
-            except Exception as e:
-                logger.error(f"Error in main loop: {e}")
+            except OSError as e:
+                # Socket-level failure; back off before retrying
+                logger.error("Socket error in main loop: %s", e)
                 time.sleep(1)
-
-        self.shutdown()
+            except Exception as e:
+                logger.error("Error in main loop: %s", e)
 
     # ---------------- Shutdown ----------------
     def shutdown(self):
         logger.info("Shutting down daemon...")
         self.running = False
-        if self.mavlink_socket:
-            self.mavlink_socket.close()
+        for sock in self.mavlink_sockets:
+            sock.close()
         if self.mqtt_client:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
@@ -4,18 +4,30 @@ MAVLink Stream Simulator
 Generates simulated MAVLink telemetry data in JSON format for testing.
 """
 
-import json
 import socket
 import time
 import random
 import argparse
 import math
+import sys
 from datetime import datetime
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Configuration
 TARGET_HOST = "127.0.0.1"
 TARGET_PORT = 14550
 UPDATE_RATE = 10  # Hz
+STATUS_REFRESH_INTERVAL = 1.0  # Seconds between status line redraws
+
+# Fixed message shape, so format bytes directly instead of going through json.dumps
+TELEMETRY_TEMPLATE = (
+    b'{"altitude":%.2f,"airspeed":%.2f,"battery_voltage":%.2f,'
+    b'"timestamp":"%s","message_type":"TELEMETRY"}'
+)
 
 
 class MAVLinkSimulator:
@@ -36,6 +48,7 @@ class MAVLinkSimulator:
         self.battery_drain_rate = 0.01  # V per second (adjustable)
         self.simulate_critical = False
         self.critical_triggered = False
+        self._last_render = 0.0
 
     def generate_telemetry(self) -> dict:
         """Generate realistic telemetry data."""
@@ -62,9 +75,40 @@ class MAVLinkSimulator:
             "message_type": "TELEMETRY"
         }
 
+    def generate_trajectory(self, samples: int):
+        """Yield telemetry for a fixed number of ticks, precomputed with NumPy."""
+        rng = np.random.default_rng()
+        ticks = np.arange(samples)
+        t = self.time_elapsed + ticks / UPDATE_RATE
+
+        altitude = np.maximum(0, 100.0 + np.sin(t * 0.1) * 5.0 + rng.uniform(-1, 1, samples))
+        airspeed = np.maximum(0, 15.0 + np.sin(t * 0.2) * 2.0 + rng.uniform(-0.5, 0.5, samples))
+        battery = np.maximum(18.0, self.battery_voltage - self.battery_drain_rate / UPDATE_RATE * (ticks + 1))
+        voltage = battery + rng.uniform(-0.05, 0.05, samples)
+
+        for alt, speed, batt, volt in zip(
+            np.round(altitude, 2).tolist(),
+            np.round(airspeed, 2).tolist(),
+            battery.tolist(),
+            np.round(voltage, 2).tolist(),
+        ):
+            self.altitude, self.airspeed, self.battery_voltage = alt, speed, batt
+            yield {
+                "altitude": alt,
+                "airspeed": speed,
+                "battery_voltage": volt,
+                "timestamp": datetime.utcnow().isoformat(),
+                "message_type": "TELEMETRY"
+            }
+
     def send_telemetry(self, telemetry: dict):
         """Send telemetry data via UDP."""
-        message = json.dumps(telemetry).encode('utf-8')
+        message = TELEMETRY_TEMPLATE % (
+            telemetry["altitude"],
+            telemetry["airspeed"],
+            telemetry["battery_voltage"],
+            telemetry["timestamp"].encode(),
+        )
         self.socket.sendto(message, (self.host, self.port))
 
     def run(self, duration: int = None, fast_drain: bool = False):
@@ -89,11 +133,18 @@ class MAVLinkSimulator:
         start_time = time.time()
         interval = 1.0 / UPDATE_RATE
 
+        # Fixed-length runs can precompute the whole trajectory up front
+        trajectory = None
+        if duration and np is not None:
+            trajectory = self.generate_trajectory(int(duration * UPDATE_RATE) + 1)
+
         try:
             while True:
                 loop_start = time.time()
 
-                telemetry = self.generate_telemetry()
+                telemetry = next(trajectory, None) if trajectory is not None else None
+                if telemetry is None:
+                    telemetry = self.generate_telemetry()
                 self.send_telemetry(telemetry)
 
                 # Log status
@@ -106,12 +157,14 @@ class MAVLinkSimulator:
                 elif telemetry["battery_voltage"] < 22.0:
                     status = "WARNING"
 
-                print(
-                    f"[{status:8}] Alt: {telemetry['altitude']:6.1f}m | "
-                    f"Speed: {telemetry['airspeed']:5.1f}m/s | "
-                    f"Battery: {telemetry['battery_voltage']:5.2f}V",
-                    end='\r'
-                )
+                if loop_start - self._last_render >= STATUS_REFRESH_INTERVAL:
+                    sys.stdout.write(
+                        f"[{status:8}] Alt: {telemetry['altitude']:6.1f}m | "
+                        f"Speed: {telemetry['airspeed']:5.1f}m/s | "
+                        f"Battery: {telemetry['battery_voltage']:5.2f}V\r"
+                    )
+                    sys.stdout.flush()
+                    self._last_render = loop_start
 
                 self.time_elapsed += interval
 